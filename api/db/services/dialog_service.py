@@ -15,11 +15,19 @@
 #
 import binascii
 import logging
+import queue
 import re
+import threading
 import time
-from copy import deepcopy
+from collections import defaultdict, deque
+from concurrent.futures import ThreadPoolExecutor
 from timeit import default_timer as timer
 
+import numpy as np
+import xxhash
+from cachetools import LRUCache, TTLCache, cached
+from cachetools.keys import hashkey
+
 from api import settings
 from api.db import LLMType, ParserType, StatusEnum
 from api.db.db_models import DB, Dialog
@@ -34,6 +42,95 @@ from rag.utils import num_tokens_from_string, rmSpace
 
 from .database import MINIO_CONFIG
 
+# 流式输出与 SQL 清洗中反复使用的正则，在模块加载时预编译
+_CITE_RE = re.compile(r"##\d+\$\$")
+_CITE_GROUP_RE = re.compile(r"##([0-9]+)\$\$")
+_THINK_RE = re.compile(r"<think>.*</think>", re.DOTALL)
+_WS_RE = re.compile(r" +")
+_CRLF_RE = re.compile(r"[\r\n]+")
+_SQL_PREFIX_RE = re.compile(r".*select ")
+_SQL_TRAIL_RE = re.compile(r"([;；]|```).*")
+_SQL_AGG_RE = re.compile(r"((sum|avg|max|min)\(|group by )")
+_FIELD_NOTE_RE = re.compile(r"(/.*|（[^（）]+）)")
+_ROW_BLANK_RE = re.compile(r"[ |]+")
+_TS_RE = re.compile(r"T[0-9]{2}:[0-9]{2}:[0-9]{2}(\.[0-9]+Z)?\|")
+
+
+# 对话准备阶段的模型绑定与知识库元数据查询共用的线程池；池中任务互不等待，关键词生成、检索等耗时调用留在请求线程执行
+_executor = ThreadPoolExecutor(max_workers=32, thread_name_prefix="dialog")
+
+# 各知识库的变更版本号；缓存键带上所请求知识库的版本，某个知识库变更只使涉及它的旧条目失效
+_kb_versions = defaultdict(int)
+_kb_versions_lock = threading.Lock()
+
+
+def _bump_kb_version(kb_id=None):
+    # 未指定 ID 的变更只可能是新建知识库，它不会出现在任何已有的缓存键中
+    if not kb_id:
+        return
+    with _kb_versions_lock:
+        _kb_versions[kb_id] += 1
+
+
+def _kb_versions_of(kb_ids):
+    return tuple(_kb_versions.get(kb_id, 0) for kb_id in kb_ids)
+
+
+KnowledgebaseService.register_change_hook(_bump_kb_version)
+
+
+@cached(cache=TTLCache(maxsize=1024, ttl=60), lock=threading.Lock())
+def _cached_get_kbs(kb_ids, version):
+    return tuple(KnowledgebaseService.get_by_ids(list(kb_ids)))
+
+
+@cached(cache=TTLCache(maxsize=1024, ttl=60), lock=threading.Lock())
+def _cached_field_map(kb_ids, version):
+    return KnowledgebaseService.get_field_map(list(kb_ids))
+
+
+@cached(cache=TTLCache(maxsize=1024, ttl=60), lock=threading.Lock())
+def _cached_model_config(tenant_id, llm_type, llm_name):
+    return TenantLLMService.get_model_config(tenant_id, llm_type, llm_name)
+
+
+@cached(cache=LRUCache(maxsize=256), lock=threading.Lock())
+def _cached_llm_type(llm_id):
+    return llm_id2llm_type(llm_id)
+
+
+def _chunk_fingerprint(ck):
+    # 编辑 chunk 时 ID 保持不变，因此键中同时带上内容哈希
+    return ck["chunk_id"], xxhash.xxh64(ck["content_with_weight"].encode("utf-8")).hexdigest()
+
+
+@cached(
+    cache=TTLCache(maxsize=512, ttl=120),
+    key=lambda kbinfos, max_tokens: hashkey(tuple(_chunk_fingerprint(ck) for ck in kbinfos["chunks"]), max_tokens),
+    lock=threading.Lock(),
+)
+def _cached_kb_prompt(kbinfos, max_tokens):
+    """按 (chunk ID, 内容哈希) 序列缓存 kb_prompt 的格式化结果；文档名称、元数据等文档级信息的修改由有效期兜底"""
+    return tuple(kb_prompt(kbinfos, max_tokens))
+
+
+def _chat_llm_type(llm_id):
+    """对话模型的类型：图像理解模型按 IMAGE2TEXT 绑定，其余按 CHAT 绑定"""
+    return LLMType.IMAGE2TEXT if _cached_llm_type(llm_id) == "image2text" else LLMType.CHAT
+
+
+@cached(
+    cache=TTLCache(maxsize=2048, ttl=300),
+    key=lambda embd_mdl, question: hashkey(embd_mdl.tenant_id, embd_mdl.llm_name, " ".join(question.split())),
+    lock=threading.Lock(),
+)
+def get_cached_embedding(embd_mdl, question):
+    """获取问题的查询向量，按 (tenant_id, 嵌入模型, 规整后的问题) 缓存，命中时跳过嵌入模型调用；返回的只读 float32 数组被多个请求共享"""
+    qv, _ = embd_mdl.encode_queries(question)
+    vec = np.asarray(qv, dtype=np.float32)
+    vec.setflags(write=False)
+    return vec
+
 
 class DialogService(CommonService):
     model = Dialog
@@ -57,28 +154,121 @@ class DialogService(CommonService):
         return list(chats.dicts())
 
 
+class TTSWorker:
+    """在后台线程中合成语音，文本流式输出不再等待 TTS 调用；未配置 TTS 模型时各方法均为空操作"""
+
+    def __init__(self, tts_mdl):
+        self.tts_mdl = tts_mdl
+        self._queue = queue.Queue()
+        self._results = deque()
+        self._cancelled = threading.Event()
+        self._thread = None
+        if tts_mdl:
+            self._thread = threading.Thread(target=self._run, daemon=True)
+            self._thread.start()
+
+    def _run(self):
+        stopped = False
+        while not stopped:
+            texts = [self._queue.get()]
+            # 合并队列中已积压的片段，一次性交给 TTS 模型
+            while True:
+                try:
+                    texts.append(self._queue.get_nowait())
+                except queue.Empty:
+                    break
+            if None in texts:
+                stopped = True
+                texts = texts[: texts.index(None)]
+            # 已取消时丢弃积压片段，不再为无人接收的音频调用 TTS 模型
+            if not texts or self._cancelled.is_set():
+                continue
+            try:
+                self._results.append(tts(self.tts_mdl, "".join(texts)))
+            except Exception:
+                logging.exception("TTSWorker failed to synthesize audio")
+
+    def put(self, text):
+        if self._thread and text:
+            self._queue.put(text)
+
+    def drain(self):
+        """非阻塞地取出已合成的音频（十六进制字符串），没有则返回 None"""
+        audio = []
+        while self._results:
+            audio.append(self._results.popleft())
+        audio = [a for a in audio if a]
+        return "".join(audio) if audio else None
+
+    def stop(self):
+        if self._thread:
+            self._queue.put(None)
+
+    def cancel(self):
+        """放弃尚未合成的片段并结束后台线程，用于流式输出被中止的情况"""
+        if self._thread:
+            self._cancelled.set()
+            self._queue.put(None)
+
+    def close(self):
+        """等待剩余片段合成完毕并返回其音频"""
+        if not self._thread:
+            return None
+        self.stop()
+        self._thread.join()
+        return self.drain()
+
+
+def _strip_vectors(kbinfos):
+    """浅拷贝检索结果并去掉各 chunk 的向量字段，避免 deepcopy 复制整段向量"""
+    return {
+        "total": kbinfos["total"],
+        "doc_aggs": list(kbinfos["doc_aggs"]),
+        "chunks": [{k: v for k, v in c.items() if k != "vector"} for c in kbinfos["chunks"]],
+    }
+
+
+def _should_insert_citations(answer, chunks):
+    """判断是否需要做基于相似度的引用插入：无检索结果、回答过短或为报错提示时跳过；已有引用由调用方判断"""
+    if not chunks or len(answer) < 64:
+        return False
+    lower = answer.lower()
+    return "invalid key" not in lower and "invalid api" not in lower
+
+
+def _enough_tokens(delta, threshold=16):
+    """判断新增片段是否达到返回阈值；每个 token 至少占 1 个 UTF-8 字节，字节数不足时无需调用分词器"""
+    return len(delta.encode("utf-8")) >= threshold and num_tokens_from_string(delta) >= threshold
+
+
 def chat_solo(dialog, messages, stream=True):
-    if llm_id2llm_type(dialog.llm_id) == "image2text":
-        chat_mdl = LLMBundle(dialog.tenant_id, LLMType.IMAGE2TEXT, dialog.llm_id)
-    else:
-        chat_mdl = LLMBundle(dialog.tenant_id, LLMType.CHAT, dialog.llm_id)
+    chat_mdl = LLMBundle(dialog.tenant_id, _chat_llm_type(dialog.llm_id), dialog.llm_id)
 
     prompt_config = dialog.prompt_config
     tts_mdl = None
     if prompt_config.get("tts"):
         tts_mdl = LLMBundle(dialog.tenant_id, LLMType.TTS)
-    msg = [{"role": m["role"], "content": re.sub(r"##\d+\$\$", "", m["content"])} for m in messages if m["role"] != "system"]
+    msg = [{"role": m["role"], "content": _CITE_RE.sub("", m["content"])} for m in messages if m["role"] != "system"]
     if stream:
-        last_ans = ""
-        for ans in chat_mdl.chat_streamly(prompt_config.get("system", ""), msg, dialog.llm_setting):
-            answer = ans
-            delta_ans = ans[len(last_ans) :]
-            if num_tokens_from_string(delta_ans) < 16:
-                continue
-            last_ans = answer
-            yield {"answer": answer, "reference": {}, "audio_binary": tts(tts_mdl, delta_ans), "prompt": "", "created_at": time.time()}
-        if delta_ans:
-            yield {"answer": answer, "reference": {}, "audio_binary": tts(tts_mdl, delta_ans), "prompt": "", "created_at": time.time()}
+        last_len = 0
+        answer = ""
+        tts_worker = TTSWorker(tts_mdl)
+        try:
+            for ans in chat_mdl.chat_streamly(prompt_config.get("system", ""), msg, dialog.llm_setting):
+                answer = ans
+                delta_ans = ans[last_len:]
+                if not _enough_tokens(delta_ans):
+                    continue
+                last_len = len(answer)
+                tts_worker.put(delta_ans)
+                yield {"answer": answer, "reference": {}, "audio_binary": tts_worker.drain(), "prompt": "", "created_at": time.time()}
+            delta_ans = answer[last_len:]
+            tts_worker.put(delta_ans)
+            audio = tts_worker.close()
+            if delta_ans or audio:
+                yield {"answer": answer, "reference": {}, "audio_binary": audio, "prompt": "", "created_at": time.time()}
+        finally:
+            tts_worker.cancel()
     else:
         answer = chat_mdl.chat(prompt_config.get("system", ""), msg, dialog.llm_setting)
         user_content = msg[-1].get("content", "[content not available]")
@@ -95,106 +285,133 @@ def chat(dialog, messages, stream=True, **kwargs):
 
     chat_start_ts = timer()
 
-    if llm_id2llm_type(dialog.llm_id) == "image2text":
-        llm_model_config = TenantLLMService.get_model_config(dialog.tenant_id, LLMType.IMAGE2TEXT, dialog.llm_id)
-    else:
-        llm_model_config = TenantLLMService.get_model_config(dialog.tenant_id, LLMType.CHAT, dialog.llm_id)
-
-    max_tokens = llm_model_config.get("max_tokens", 8192)
-
-    check_llm_ts = timer()
-
-    kbs = KnowledgebaseService.get_by_ids(dialog.kb_ids)
-    embedding_list = list(set([kb.embd_id for kb in kbs]))
-    if len(embedding_list) != 1:
-        yield {"answer": "**ERROR**: Knowledge bases use different embedding models.", "reference": []}
-        return {"answer": "**ERROR**: Knowledge bases use different embedding models.", "reference": []}
-
-    embedding_model_name = embedding_list[0]
-
-    retriever = settings.retrievaler
-
-    questions = [m["content"] for m in messages if m["role"] == "user"][-3:]
-    attachments = kwargs["doc_ids"].split(",") if "doc_ids" in kwargs else None
-    if "doc_ids" in messages[-1]:
-        attachments = messages[-1]["doc_ids"]
+    prompt_config = dialog.prompt_config
+    param_keys = {p["key"] for p in prompt_config["parameters"]}
+    # 模型绑定与知识库元数据查询彼此独立，并发执行，总等待时间取决于最慢的一项
+    llm_type = _chat_llm_type(dialog.llm_id)
+    llm_config_future = _executor.submit(_cached_model_config, dialog.tenant_id, llm_type, dialog.llm_id)
+    chat_mdl_future = _executor.submit(LLMBundle, dialog.tenant_id, llm_type, dialog.llm_id)
+    kb_key = tuple(sorted(dialog.kb_ids))
+    kb_version = _kb_versions_of(kb_key)
+    kbs_future = _executor.submit(_cached_get_kbs, kb_key, kb_version)
+    field_map_future = _executor.submit(_cached_field_map, kb_key, kb_version)
+    rerank_mdl_future = _executor.submit(LLMBundle, dialog.tenant_id, LLMType.RERANK, dialog.rerank_id) if dialog.rerank_id else None
+    tts_mdl_future = _executor.submit(LLMBundle, dialog.tenant_id, LLMType.TTS) if prompt_config.get("tts") else None
+
+    rank_feature_future = None
+    try:
+        llm_model_config = llm_config_future.result()
+        max_tokens = llm_model_config.get("max_tokens", 8192)
+
+        check_llm_ts = timer()
+
+        kbs = kbs_future.result()
+        embedding_list = list(set([kb.embd_id for kb in kbs]))
+        if len(embedding_list) != 1:
+            yield {"answer": "**ERROR**: Knowledge bases use different embedding models.", "reference": []}
+            return {"answer": "**ERROR**: Knowledge bases use different embedding models.", "reference": []}
+
+        # 参数检查只依赖请求参数与提示词配置，在发起任何 LLM 调用之前完成
+        for p in prompt_config["parameters"]:
+            if p["key"] == "knowledge":
+                continue
+            if p["key"] not in kwargs and not p["optional"]:
+                raise KeyError("Miss parameter: " + p["key"])
+            if p["key"] not in kwargs:
+                prompt_config["system"] = prompt_config["system"].replace("{%s}" % p["key"], " ")
 
-    create_retriever_ts = timer()
+        embedding_model_name = embedding_list[0]
 
-    embd_mdl = LLMBundle(dialog.tenant_id, LLMType.EMBEDDING, embedding_model_name)
-    if not embd_mdl:
-        raise LookupError("Embedding model(%s) not found" % embedding_model_name)
+        retriever = settings.retrievaler
 
-    bind_embedding_ts = timer()
+        questions = [m["content"] for m in messages if m["role"] == "user"][-3:]
+        attachments = kwargs["doc_ids"].split(",") if "doc_ids" in kwargs else None
+        if "doc_ids" in messages[-1]:
+            attachments = messages[-1]["doc_ids"]
 
-    if llm_id2llm_type(dialog.llm_id) == "image2text":
-        chat_mdl = LLMBundle(dialog.tenant_id, LLMType.IMAGE2TEXT, dialog.llm_id)
-    else:
-        chat_mdl = LLMBundle(dialog.tenant_id, LLMType.CHAT, dialog.llm_id)
+        create_retriever_ts = timer()
 
-    bind_llm_ts = timer()
+        embd_mdl = LLMBundle(dialog.tenant_id, LLMType.EMBEDDING, embedding_model_name)
+        if not embd_mdl:
+            raise LookupError("Embedding model(%s) not found" % embedding_model_name)
 
-    prompt_config = dialog.prompt_config
-    field_map = KnowledgebaseService.get_field_map(dialog.kb_ids)
-    tts_mdl = None
-    if prompt_config.get("tts"):
-        tts_mdl = LLMBundle(dialog.tenant_id, LLMType.TTS)
-    # try to use sql if field mapping is good to go
-    if field_map:
-        logging.debug("Use SQL to retrieval:{}".format(questions[-1]))
-        ans = use_sql(questions[-1], field_map, dialog.tenant_id, chat_mdl, prompt_config.get("quote", True))
-        if ans:
-            yield ans
-            return
+        bind_embedding_ts = timer()
 
-    for p in prompt_config["parameters"]:
-        if p["key"] == "knowledge":
-            continue
-        if p["key"] not in kwargs and not p["optional"]:
-            raise KeyError("Miss parameter: " + p["key"])
-        if p["key"] not in kwargs:
-            prompt_config["system"] = prompt_config["system"].replace("{%s}" % p["key"], " ")
+        field_map = field_map_future.result()
+        # 未启用关键词时检索问题就是最后一条用户消息：排序特征放入线程池，查询向量在等待对话模型等绑定期间计算
+        query_vector = None
+        if not prompt_config.get("keyword", False) and "knowledge" in param_keys and not field_map:
+            rank_feature_future = _executor.submit(label_question, questions[-1], kbs)
+            query_vector = get_cached_embedding(embd_mdl, questions[-1])
 
-    questions = questions[-1:]
+        chat_mdl = chat_mdl_future.result()
 
-    refine_question_ts = timer()
+        bind_llm_ts = timer()
 
-    rerank_mdl = None
-    if dialog.rerank_id:
-        rerank_mdl = LLMBundle(dialog.tenant_id, LLMType.RERANK, dialog.rerank_id)
+        tts_mdl = tts_mdl_future.result() if tts_mdl_future else None
+        # try to use sql if field mapping is good to go
+        if field_map:
+            logging.debug("Use SQL to retrieval:{}".format(questions[-1]))
+            ans = use_sql(questions[-1], field_map, dialog.tenant_id, chat_mdl, prompt_config.get("quote", True))
+            if ans:
+                yield ans
+                return
 
-    bind_reranker_ts = timer()
-    generate_keyword_ts = bind_reranker_ts
-    thought = ""
-    kbinfos = {"total": 0, "chunks": [], "doc_aggs": []}
+        questions = questions[-1:]
 
-    if "knowledge" not in [p["key"] for p in prompt_config["parameters"]]:
-        knowledges = []
-    else:
-        if prompt_config.get("keyword", False):
-            questions[-1] += keyword_extraction(chat_mdl, questions[-1])
-            generate_keyword_ts = timer()
+        refine_question_ts = timer()
 
-        tenant_ids = list(set([kb.tenant_id for kb in kbs]))
+        rerank_mdl = rerank_mdl_future.result() if rerank_mdl_future else None
 
+        bind_reranker_ts = timer()
+        generate_keyword_ts = bind_reranker_ts
+        thought = ""
+        kbinfos = {"total": 0, "chunks": [], "doc_aggs": []}
         knowledges = []
-
-        kbinfos = retriever.retrieval(
-            " ".join(questions),
-            embd_mdl,
-            tenant_ids,
-            dialog.kb_ids,
-            1,
-            dialog.top_n,
-            dialog.similarity_threshold,
-            dialog.vector_similarity_weight,
-            doc_ids=attachments,
-            top=dialog.top_k,
-            aggs=False,
-            rerank_mdl=rerank_mdl,
-            rank_feature=label_question(" ".join(questions), kbs),
-        )
-        knowledges = kb_prompt(kbinfos, max_tokens)
+        chunk_mat = None
+
+        if "knowledge" in param_keys:
+            if prompt_config.get("keyword", False):
+                questions[-1] += keyword_extraction(chat_mdl, questions[-1])
+                generate_keyword_ts = timer()
+
+            tenant_ids = list(set([kb.tenant_id for kb in kbs]))
+            question = " ".join(questions)
+            # 排序特征与查询向量互不依赖，排序特征先行提交
+            if rank_feature_future is None:
+                rank_feature_future = _executor.submit(label_question, question, kbs)
+            if query_vector is None:
+                query_vector = get_cached_embedding(embd_mdl, question)
+            kbinfos = retriever.retrieval_with_vector(
+                query_vector,
+                question,
+                embd_mdl,
+                tenant_ids,
+                dialog.kb_ids,
+                1,
+                dialog.top_n,
+                dialog.similarity_threshold,
+                dialog.vector_similarity_weight,
+                doc_ids=attachments,
+                top=dialog.top_k,
+                aggs=False,
+                rerank_mdl=rerank_mdl,
+                rank_feature=rank_feature_future.result(),
+            )
+            # 引用插入所需的 chunk 向量压缩为一个按行归一化的 float32 矩阵，检索结果本身不再携带向量列表
+            if prompt_config.get("quote", True) and kwargs.get("quote", True):
+                chunk_mat = retriever.normalize_rows(retriever.stack_vectors([ck["vector"] for ck in kbinfos["chunks"]]))
+            kbinfos = _strip_vectors(kbinfos)
+            knowledges = _cached_kb_prompt(kbinfos, max_tokens)
+
+        # 过滤掉 system 角色的消息(因为后面会单独处理系统消息)
+        history = [{"role": m["role"], "content": _CITE_RE.sub("", m["content"])} for m in messages if m["role"] != "system"]
+        citation_tpl = citation_prompt()
+    finally:
+        # 报错、SQL 检索命中或生成器被提前关闭时，取消线程池中尚未开始执行的任务
+        for future in (llm_config_future, chat_mdl_future, kbs_future, field_map_future, rerank_mdl_future, tts_mdl_future, rank_feature_future):
+            if future:
+                future.cancel()
 
     logging.debug("{}->{}".format(" ".join(questions), "\n->".join(knowledges)))
 
@@ -210,9 +427,8 @@ def chat(dialog, messages, stream=True, **kwargs):
     msg = [{"role": "system", "content": prompt_config["system"].format(**kwargs)}]
     prompt4citation = ""
     if knowledges and (prompt_config.get("quote", True) and kwargs.get("quote", True)):
-        prompt4citation = citation_prompt()
-    # 过滤掉 system 角色的消息(因为前面已经单独处理了系统消息)
-    msg.extend([{"role": m["role"], "content": re.sub(r"##\d+\$\$", "", m["content"])} for m in messages if m["role"] != "system"])
+        prompt4citation = citation_tpl
+    msg.extend(history)
     used_token_count, msg = message_fit_in(msg, int(max_tokens * 0.95))
     assert len(msg) >= 2, f"message_fit_in has bug: {msg}"
     prompt = msg[0]["content"]
@@ -235,31 +451,16 @@ def chat(dialog, messages, stream=True, **kwargs):
         processed_image_urls = set()
 
         if knowledges and (prompt_config.get("quote", True) and kwargs.get("quote", True)):
-            # 获取引用的 chunk 索引
-            if not re.search(r"##[0-9]+\$\$", answer):
-                answer, idx = retriever.insert_citations(
-                    answer,
-                    [ck["content_ltks"] for ck in kbinfos["chunks"]],
-                    [ck["vector"] for ck in kbinfos["chunks"]],
-                    embd_mdl,
-                    tkweight=1 - dialog.vector_similarity_weight,
-                    vtweight=dialog.vector_similarity_weight,
-                )
-                cited_chunk_indices = idx
-            else:
-                for r in re.finditer(r"##([0-9]+)\$\$", answer):
-                    i = int(r.group(1))
-                    if i < len(kbinfos["chunks"]):
-                        cited_chunk_indices.add(i)
+            chunks = kbinfos["chunks"]
 
-            # 处理图片插入
-            def insert_image_markdown(match):
+            # 记录引用的 chunk 索引，并在引用后插入对应图片
+            def cite_and_insert_image(match):
                 idx = int(match.group(1))
-                if idx >= len(kbinfos["chunks"]):
+                if idx >= len(chunks):
                     return match.group(0)
+                cited_chunk_indices.add(idx)
 
-                chunk = kbinfos["chunks"][idx]
-                img_path = chunk.get("image_id")
+                img_path = chunks[idx].get("image_id")
                 if not img_path:
                     return match.group(0)
 
@@ -275,8 +476,19 @@ def chat(dialog, messages, stream=True, **kwargs):
                 # 插入图片，并限制最大宽度
                 return f'{match.group(0)}\n\n<img src="{img_url}" alt="{img_url}" style="max-width:800px;">'
 
-            # 用正则替换插图
-            answer = re.sub(r"##(\d+)\$\$", insert_image_markdown, answer)
+            # 一次正则扫描同时收集已有引用并插入图片
+            answer = _CITE_GROUP_RE.sub(cite_and_insert_image, answer)
+            # 回答未自带引用时按相似度插入引用，再为新引用插入图片
+            if not cited_chunk_indices and _should_insert_citations(answer, chunks):
+                answer, _ = retriever.insert_citations_vec(
+                    answer,
+                    [ck["content_ltks"] for ck in chunks],
+                    chunk_mat,
+                    embd_mdl,
+                    tkweight=1 - dialog.vector_similarity_weight,
+                    vtweight=dialog.vector_similarity_weight,
+                )
+                answer = _CITE_GROUP_RE.sub(cite_and_insert_image, answer)
 
             # 清理引用文献信息
             idx = set([kbinfos["chunks"][int(i)]["doc_id"] for i in cited_chunk_indices])
@@ -285,53 +497,59 @@ def chat(dialog, messages, stream=True, **kwargs):
                 recall_docs = kbinfos["doc_aggs"]
             kbinfos["doc_aggs"] = recall_docs
 
-            refs = deepcopy(kbinfos)
-            for c in refs["chunks"]:
-                if c.get("vector"):
-                    del c["vector"]
+            refs = kbinfos
 
         # 特殊错误提示
         if "invalid key" in answer.lower() or "invalid api" in answer.lower():
             answer += " Please set LLM API-Key in 'User Setting -> Model providers -> API-Key'"
 
-        # 时间信息拼接
-        finish_chat_ts = timer()
-        total_time_cost = (finish_chat_ts - chat_start_ts) * 1000
-        check_llm_time_cost = (check_llm_ts - chat_start_ts) * 1000
-        create_retriever_time_cost = (create_retriever_ts - check_llm_ts) * 1000
-        bind_embedding_time_cost = (bind_embedding_ts - create_retriever_ts) * 1000
-        bind_llm_time_cost = (bind_llm_ts - bind_embedding_ts) * 1000
-        refine_question_time_cost = (refine_question_ts - bind_llm_ts) * 1000
-        bind_reranker_time_cost = (bind_reranker_ts - refine_question_ts) * 1000
-        generate_keyword_time_cost = (generate_keyword_ts - bind_reranker_ts) * 1000
-        retrieval_time_cost = (retrieval_ts - generate_keyword_ts) * 1000
-        generate_result_time_cost = (finish_chat_ts - retrieval_ts) * 1000
-
         prompt += "\n\n### Query:\n%s" % " ".join(questions)
-        prompt = f"{prompt}\n\n - Total: {total_time_cost:.1f}ms\n  - Check LLM: {check_llm_time_cost:.1f}ms\n  - Create retriever: {create_retriever_time_cost:.1f}ms\n  - Bind embedding: {bind_embedding_time_cost:.1f}ms\n  - Bind LLM: {bind_llm_time_cost:.1f}ms\n  - Tune question: {refine_question_time_cost:.1f}ms\n  - Bind reranker: {bind_reranker_time_cost:.1f}ms\n  - Generate keyword: {generate_keyword_time_cost:.1f}ms\n  - Retrieval: {retrieval_time_cost:.1f}ms\n  - Generate answer: {generate_result_time_cost:.1f}ms"
-
-        return {"answer": think + answer, "reference": refs, "prompt": re.sub(r"\n", "  \n", prompt), "created_at": time.time()}
+        # 各阶段耗时仅在开启调试开关时拼接到 prompt 中
+        if settings.ENABLE_TIMING_IN_PROMPT:
+            finish_chat_ts = timer()
+            total_time_cost = (finish_chat_ts - chat_start_ts) * 1000
+            check_llm_time_cost = (check_llm_ts - chat_start_ts) * 1000
+            create_retriever_time_cost = (create_retriever_ts - check_llm_ts) * 1000
+            bind_embedding_time_cost = (bind_embedding_ts - create_retriever_ts) * 1000
+            bind_llm_time_cost = (bind_llm_ts - bind_embedding_ts) * 1000
+            refine_question_time_cost = (refine_question_ts - bind_llm_ts) * 1000
+            bind_reranker_time_cost = (bind_reranker_ts - refine_question_ts) * 1000
+            generate_keyword_time_cost = (generate_keyword_ts - bind_reranker_ts) * 1000
+            retrieval_time_cost = (retrieval_ts - generate_keyword_ts) * 1000
+            generate_result_time_cost = (finish_chat_ts - retrieval_ts) * 1000
+            prompt = f"{prompt}\n\n - Total: {total_time_cost:.1f}ms\n  - Check LLM: {check_llm_time_cost:.1f}ms\n  - Create retriever: {create_retriever_time_cost:.1f}ms\n  - Bind embedding: {bind_embedding_time_cost:.1f}ms\n  - Bind LLM: {bind_llm_time_cost:.1f}ms\n  - Tune question: {refine_question_time_cost:.1f}ms\n  - Bind reranker: {bind_reranker_time_cost:.1f}ms\n  - Generate keyword: {generate_keyword_time_cost:.1f}ms\n  - Retrieval: {retrieval_time_cost:.1f}ms\n  - Generate answer: {generate_result_time_cost:.1f}ms"
+
+        return {"answer": think + answer, "reference": refs, "prompt": prompt.replace("\n", "  \n"), "created_at": time.time()}
 
     if stream:
-        last_ans = ""  # 记录上一次返回的完整回答
+        last_len = 0  # 上一次返回时完整回答的长度
         answer = ""  # 当前累计的完整回答
-        for ans in chat_mdl.chat_streamly(prompt + prompt4citation, msg[1:], gen_conf):
-            # 如果存在思考过程(thought)，移除相关标记
-            if thought:
-                ans = re.sub(r"<think>.*</think>", "", ans, flags=re.DOTALL)
-            answer = ans
-            # 计算新增的文本片段(delta)
-            delta_ans = ans[len(last_ans) :]
-            # 如果新增token太少(小于16)，跳过本次返回(避免频繁发送小片段)
-            if num_tokens_from_string(delta_ans) < 16:
-                continue
-            last_ans = answer
-            # 返回当前累计回答(包含思考过程)+新增片段)
-            yield {"answer": thought + answer, "reference": {}, "audio_binary": tts(tts_mdl, delta_ans)}
-        delta_ans = answer[len(last_ans) :]
-        if delta_ans:
-            yield {"answer": thought + answer, "reference": {}, "audio_binary": tts(tts_mdl, delta_ans)}
-        yield decorate_answer(thought + answer)
+        # 语音合成放到后台线程，文本片段无需等待 TTS 即可返回
+        tts_worker = TTSWorker(tts_mdl)
+        try:
+            for ans in chat_mdl.chat_streamly(prompt + prompt4citation, msg[1:], gen_conf):
+                # 如果存在思考过程(thought)，移除相关标记
+                if thought:
+                    ans = _THINK_RE.sub("", ans)
+                answer = ans
+                # 计算新增的文本片段(delta)
+                delta_ans = ans[last_len:]
+                # 如果新增token太少(小于16)，跳过本次返回(避免频繁发送小片段)
+                if not _enough_tokens(delta_ans):
+                    continue
+                last_len = len(answer)
+                tts_worker.put(delta_ans)
+                # 返回当前累计回答(包含思考过程)，附带已合成完毕的音频
+                yield {"answer": thought + answer, "reference": {}, "audio_binary": tts_worker.drain()}
+            full_answer = thought + answer
+            delta_ans = answer[last_len:]
+            tts_worker.put(delta_ans)
+            audio = tts_worker.close()
+            if delta_ans or audio:
+                yield {"answer": full_answer, "reference": {}, "audio_binary": audio}
+        finally:
+            tts_worker.cancel()
+        yield decorate_answer(full_answer)
     else:
         answer = chat_mdl.chat(prompt + prompt4citation, msg[1:], gen_conf)
         user_content = msg[-1].get("content", "[content not available]")
@@ -357,15 +575,15 @@ Please write the SQL, only SQL, without any other explanations or text.
     def get_table():
         nonlocal sys_prompt, user_prompt, question, tried_times
         sql = chat_mdl.chat(sys_prompt, [{"role": "user", "content": user_prompt}], {"temperature": 0.06})
-        sql = re.sub(r"<think>.*</think>", "", sql, flags=re.DOTALL)
+        sql = _THINK_RE.sub("", sql)
         logging.debug(f"{question} ==> {user_prompt} get SQL: {sql}")
-        sql = re.sub(r"[\r\n]+", " ", sql.lower())
-        sql = re.sub(r".*select ", "select ", sql.lower())
-        sql = re.sub(r" +", " ", sql)
-        sql = re.sub(r"([;；]|```).*", "", sql)
+        sql = _CRLF_RE.sub(" ", sql.lower())
+        sql = _SQL_PREFIX_RE.sub("select ", sql.lower())
+        sql = _WS_RE.sub(" ", sql)
+        sql = _SQL_TRAIL_RE.sub("", sql)
         if sql[: len("select ")] != "select ":
             return None, None
-        if not re.search(r"((sum|avg|max|min)\(|group by )", sql.lower()):
+        if not _SQL_AGG_RE.search(sql.lower()):
             if sql[: len("select *")] != "select *":
                 sql = "select doc_id,docnm_kwd," + sql[6:]
             else:
@@ -411,53 +629,75 @@ Please write the SQL, only SQL, without any other explanations or text.
     if tbl.get("error") or len(tbl["rows"]) == 0:
         return None
 
-    docid_idx = set([ii for ii, c in enumerate(tbl["columns"]) if c["name"] == "doc_id"])
-    doc_name_idx = set([ii for ii, c in enumerate(tbl["columns"]) if c["name"] == "docnm_kwd"])
-    column_idx = [ii for ii in range(len(tbl["columns"])) if ii not in (docid_idx | doc_name_idx)]
+    docid_idx = next((ii for ii, c in enumerate(tbl["columns"]) if c["name"] == "doc_id"), -1)
+    doc_name_idx = next((ii for ii, c in enumerate(tbl["columns"]) if c["name"] == "docnm_kwd"), -1)
+    has_doc_fields = docid_idx >= 0 and doc_name_idx >= 0
+    excluded_idx = {docid_idx, doc_name_idx} - {-1}
+    column_idx = [ii for ii in range(len(tbl["columns"])) if ii not in excluded_idx]
 
     # compose Markdown table
-    columns = (
-        "|" + "|".join([re.sub(r"(/.*|（[^（）]+）)", "", field_map.get(tbl["columns"][i]["name"], tbl["columns"][i]["name"])) for i in column_idx]) + ("|Source|" if docid_idx and docid_idx else "|")
-    )
-
-    line = "|" + "|".join(["------" for _ in range(len(column_idx))]) + ("|------|" if docid_idx and docid_idx else "")
+    columns = "|" + "|".join([_FIELD_NOTE_RE.sub("", field_map.get(tbl["columns"][i]["name"], tbl["columns"][i]["name"])) for i in column_idx]) + ("|Source|" if has_doc_fields else "|")
 
-    rows = ["|" + "|".join([rmSpace(str(r[i])) for i in column_idx]).replace("None", " ") + "|" for r in tbl["rows"]]
-    rows = [r for r in rows if re.sub(r"[ |]+", "", r)]
-    if quota:
-        rows = "\n".join([r + f" ##{ii}$$ |" for ii, r in enumerate(rows)])
-    else:
-        rows = "\n".join([r + f" ##{ii}$$ |" for ii, r in enumerate(rows)])
-    rows = re.sub(r"T[0-9]{2}:[0-9]{2}:[0-9]{2}(\.[0-9]+Z)?\|", "|", rows)
+    line = "|" + "|".join(["------" for _ in range(len(column_idx))]) + ("|------|" if has_doc_fields else "")
 
-    if not docid_idx or not doc_name_idx:
+    # 单次遍历结果行：生成 Markdown 行，同时统计引用文档
+    rows = []
+    ref_chunks = []
+    doc_aggs = defaultdict(lambda: {"doc_name": None, "count": 0})
+    for r in tbl["rows"]:
+        row = "|" + "|".join([rmSpace(str(r[i])) for i in column_idx]).replace("None", " ") + "|"
+        if _ROW_BLANK_RE.sub("", row):
+            rows.append(row)
+        if has_doc_fields:
+            agg = doc_aggs[r[docid_idx]]
+            if agg["count"] == 0:
+                agg["doc_name"] = r[doc_name_idx]
+            agg["count"] += 1
+            ref_chunks.append({"doc_id": r[docid_idx], "docnm_kwd": r[doc_name_idx]})
+    rows = "\n".join([r + f" ##{ii}$$ |" for ii, r in enumerate(rows)])
+    rows = _TS_RE.sub("|", rows)
+
+    if not has_doc_fields:
         logging.warning("SQL missing field: " + sql)
         return {"answer": "\n".join([columns, line, rows]), "reference": {"chunks": [], "doc_aggs": []}, "prompt": sys_prompt}
 
-    docid_idx = list(docid_idx)[0]
-    doc_name_idx = list(doc_name_idx)[0]
-    doc_aggs = {}
-    for r in tbl["rows"]:
-        if r[docid_idx] not in doc_aggs:
-            doc_aggs[r[docid_idx]] = {"doc_name": r[doc_name_idx], "count": 0}
-        doc_aggs[r[docid_idx]]["count"] += 1
     return {
         "answer": "\n".join([columns, line, rows]),
         "reference": {
-            "chunks": [{"doc_id": r[docid_idx], "docnm_kwd": r[doc_name_idx]} for r in tbl["rows"]],
+            "chunks": ref_chunks,
             "doc_aggs": [{"doc_id": did, "doc_name": d["doc_name"], "count": d["count"]} for did, d in doc_aggs.items()],
         },
         "prompt": sys_prompt,
     }
 
 
+@cached(
+    cache=TTLCache(maxsize=512, ttl=120),
+    key=lambda retriever, embd_mdl, kbs, kb_ids, question, max_tokens, version: hashkey(embd_mdl.tenant_id, embd_mdl.llm_name, kb_ids, question, max_tokens, version),
+    lock=threading.Lock(),
+)
+def _retrieve_and_format(retriever, embd_mdl, kbs, kb_ids, question, max_tokens, version):
+    """
+    检索并格式化知识库上下文，相同问题在有效期内直接复用结果；返回值被多个请求共享，调用方不得修改。
+    缓存的检索结果不含 chunk 向量，引用插入所需的向量以按行归一化的 float32 矩阵单独保存
+    """
+    tenant_ids = list(set([kb.tenant_id for kb in kbs]))
+    # 设置更小的相似度阈值以适配更好的效果(原始值0.1)
+    similarity_threshold = 0.01
+    query_vector = get_cached_embedding(embd_mdl, question)
+    kbinfos = retriever.retrieval_with_vector(query_vector, question, embd_mdl, tenant_ids, list(kb_ids), 1, 12, similarity_threshold, 0.3, aggs=False, rank_feature=label_question(question, kbs))
+    chunk_mat = retriever.normalize_rows(retriever.stack_vectors([ck["vector"] for ck in kbinfos["chunks"]]))
+    chunk_mat.setflags(write=False)
+    kbinfos = _strip_vectors(kbinfos)
+    # 将检索结果格式化为提示词，并确保不超过模型最大token限制
+    knowledge = "\n".join(_cached_kb_prompt(kbinfos, max_tokens))
+    return kbinfos, knowledge, chunk_mat
+
+
 def tts(tts_mdl, text):
     if not tts_mdl or not text:
         return
-    bin = b""
-    for chunk in tts_mdl.tts(text):
-        bin += chunk
-    return binascii.hexlify(bin).decode("utf-8")
+    return binascii.hexlify(b"".join(tts_mdl.tts(text))).decode("utf-8")
 
 
 def ask(question, kb_ids, tenant_id):
@@ -484,7 +724,9 @@ def ask(question, kb_ids, tenant_id):
         generator: 生成器对象，产生包含回答和引用信息的字典
     """
 
-    kbs = KnowledgebaseService.get_by_ids(kb_ids)
+    kb_key = tuple(sorted(kb_ids))
+    kb_version = _kb_versions_of(kb_key)
+    kbs = _cached_get_kbs(kb_key, kb_version)
     embedding_list = list(set([kb.embd_id for kb in kbs]))
 
     is_knowledge_graph = all([kb.parser_id == ParserType.KG for kb in kbs])
@@ -495,15 +737,10 @@ def ask(question, kb_ids, tenant_id):
     chat_mdl = LLMBundle(tenant_id, LLMType.CHAT)
     # 获取聊天模型的最大token长度，用于控制上下文长度
     max_tokens = chat_mdl.max_length
-    # 获取所有知识库的租户ID并去重
-    tenant_ids = list(set([kb.tenant_id for kb in kbs]))
-    # 设置更小的相似度阈值以适配更好的效果(原始值0.1)
-    similarity_threshold = 0.01
-    # 调用检索器检索相关文档片段
-    kbinfos = retriever.retrieval(question, embd_mdl, tenant_ids, kb_ids, 1, 12, similarity_threshold, 0.3, aggs=False, rank_feature=label_question(question, kbs))
-    # 将检索结果格式化为提示词，并确保不超过模型最大token限制
-    knowledges = kb_prompt(kbinfos, max_tokens)
-    prompt = """
+    # 检索相关文档片段并格式化为上下文（命中缓存时跳过检索）
+    kbinfos, knowledge, chunk_mat = _retrieve_and_format(retriever, embd_mdl, kbs, kb_key, question, max_tokens, kb_version)
+    prompt = (
+        """
     角色：你是一个聪明的助手。  
     任务：总结知识库中的信息并回答用户的问题。  
     要求与限制：
@@ -518,22 +755,23 @@ def ask(question, kb_ids, tenant_id):
 
     以上是来自知识库的信息。
 
-    """ % "\n".join(knowledges)
+    """
+        % knowledge
+    )
     msg = [{"role": "user", "content": question}]
 
     # 生成完成后添加回答中的引用标记
     def decorate_answer(answer):
-        nonlocal knowledges, kbinfos, prompt
-        answer, idx = retriever.insert_citations(answer, [ck["content_ltks"] for ck in kbinfos["chunks"]], [ck["vector"] for ck in kbinfos["chunks"]], embd_mdl, tkweight=0.7, vtweight=0.3)
+        nonlocal kbinfos, prompt, chunk_mat
+        idx = set([int(r.group(1)) for r in _CITE_GROUP_RE.finditer(answer) if int(r.group(1)) < len(kbinfos["chunks"])])
+        if not idx and _should_insert_citations(answer, kbinfos["chunks"]):
+            answer, idx = retriever.insert_citations_vec(answer, [ck["content_ltks"] for ck in kbinfos["chunks"]], chunk_mat, embd_mdl, tkweight=0.7, vtweight=0.3)
         idx = set([kbinfos["chunks"][int(i)]["doc_id"] for i in idx])
         recall_docs = [d for d in kbinfos["doc_aggs"] if d["doc_id"] in idx]
         if not recall_docs:
             recall_docs = kbinfos["doc_aggs"]
-        kbinfos["doc_aggs"] = recall_docs
-        refs = deepcopy(kbinfos)
-        for c in refs["chunks"]:
-            if c.get("vector"):
-                del c["vector"]
+        # kbinfos 来自检索缓存，只在副本上调整引用文档
+        refs = {**kbinfos, "doc_aggs": recall_docs}
 
         if answer.lower().find("invalid key") >= 0 or answer.lower().find("invalid api") >= 0:
             answer += " Please set LLM API-Key in 'User Setting -> Model Providers -> API-Key'"
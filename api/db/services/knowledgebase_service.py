@@ -13,6 +13,8 @@
 #  See the License for the specific language governing permissions and
 #  limitations under the License.
 #
+import logging
+
 from api.db import StatusEnum, TenantPermission
 from api.db.db_models import Knowledgebase, DB, Tenant, User, UserTenant,Document
 from api.db.services.common_service import CommonService
@@ -21,6 +23,42 @@ from peewee import fn
 
 class KnowledgebaseService(CommonService):
     model = Knowledgebase
+    # 知识库变更时触发的回调（如对话服务的缓存失效），以元组保存，注册时整体替换
+    _change_hooks = ()
+
+    @classmethod
+    def register_change_hook(cls, hook):
+        if hook not in KnowledgebaseService._change_hooks:
+            KnowledgebaseService._change_hooks = (*KnowledgebaseService._change_hooks, hook)
+
+    @classmethod
+    def notify_change(cls, kb_id=None):
+        for hook in cls._change_hooks:
+            try:
+                hook(kb_id)
+            except Exception:
+                logging.exception("KnowledgebaseService change hook failed")
+
+    @classmethod
+    def save(cls, **kwargs):
+        res = super().save(**kwargs)
+        if res:
+            cls.notify_change(kwargs.get("id"))
+        return res
+
+    @classmethod
+    def update_by_id(cls, pid, data):
+        num = super().update_by_id(pid, data)
+        if num:
+            cls.notify_change(pid)
+        return num
+
+    @classmethod
+    def delete_by_id(cls, pid):
+        num = super().delete_by_id(pid)
+        if num:
+            cls.notify_change(pid)
+        return num
 
     @classmethod
     @DB.connection_context()
@@ -26,6 +26,8 @@ from api.utils import get_base_config, decrypt_database_config
 from api.constants import RAG_FLOW_SERVICE_NAME
 
 LIGHTEN = int(os.environ.get("LIGHTEN", "0"))
+# 是否在对话返回的 prompt 中附带各阶段耗时（调试用，默认关闭）
+ENABLE_TIMING_IN_PROMPT = int(os.environ.get("ENABLE_TIMING_IN_PROMPT", "0"))
 
 LLM = None
 LLM_FACTORY = None
@@ -61,8 +63,9 @@ kg_retrievaler = None
 
 
 def init_settings():
-    global LLM, LLM_FACTORY, LLM_BASE_URL, LIGHTEN, DATABASE_TYPE, DATABASE
+    global LLM, LLM_FACTORY, LLM_BASE_URL, LIGHTEN, ENABLE_TIMING_IN_PROMPT, DATABASE_TYPE, DATABASE
     LIGHTEN = int(os.environ.get("LIGHTEN", "0"))
+    ENABLE_TIMING_IN_PROMPT = int(os.environ.get("ENABLE_TIMING_IN_PROMPT", "0"))
     DATABASE_TYPE = os.getenv("DB_TYPE", "mysql")
     DATABASE = decrypt_database_config(name=DATABASE_TYPE)
     LLM = get_base_config("user_default_llm", {})
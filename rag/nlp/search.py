@@ -45,8 +45,11 @@ class Dealer:
         keywords: list[str] | None = None
         group_docs: list[list] | None = None
 
-    def get_vector(self, txt, emb_mdl, topk=10, similarity=0.1):
-        qv, _ = emb_mdl.encode_queries(txt)
+    def get_vector(self, txt, emb_mdl, topk=10, similarity=0.1, query_vector=None):
+        if query_vector is None:
+            qv, _ = emb_mdl.encode_queries(txt)
+        else:
+            qv = query_vector
         shape = np.array(qv).shape
         if len(shape) > 1:
             raise Exception(f"Dealer.get_vector returned array's shape {shape} doesn't match expectation(exact one dimension).")
@@ -77,6 +80,7 @@ class Dealer:
                 - fields: 指定返回字段
                 - question: 查询问题文本
                 - similarity: 向量相似度阈值
+                - query_vector: 预先计算好的查询向量（可选，提供时跳过问题向量化）
             idx_names: 索引名称或列表
             kb_ids: 知识库ID列表
             emb_mdl: 嵌入模型，用于向量检索
@@ -158,7 +162,7 @@ class Dealer:
             else:
                 # 4.2.3 混合检索模式（全文+向量）
                 # 生成查询向量
-                matchDense = self.get_vector(qst, emb_mdl, topk, req.get("similarity", 0.1))
+                matchDense = self.get_vector(qst, emb_mdl, topk, req.get("similarity", 0.1), req.get("query_vector"))
                 q_vec = matchDense.embedding_data
                 # 在返回字段中加入查询向量字段
                 src.append(f"q_{len(q_vec)}_vec")
@@ -216,8 +220,31 @@ class Dealer:
     def trans2floats(txt):
         return [float(t) for t in txt.split("\t")]
 
+    @staticmethod
+    def stack_vectors(vectors):
+        """将 chunk 向量堆叠为 (num_chunks, dim) 的 float32 矩阵，维度与首个向量不符的行置零"""
+        vectors = [Dealer.trans2floats(v) if isinstance(v, str) else v for v in vectors]
+        dim = len(vectors[0]) if vectors else 0
+        mat = np.zeros((len(vectors), dim), dtype=np.float32)
+        for i, v in enumerate(vectors):
+            if len(v) == dim:
+                mat[i] = v
+            else:
+                logging.warning("The dimension of chunk vectors do not match: {} vs. {}".format(len(v), dim))
+        return mat
+
+    @staticmethod
+    def normalize_rows(mat):
+        norms = np.linalg.norm(mat, axis=1, keepdims=True)
+        return mat / np.where(norms == 0, 1, norms)
+
     def insert_citations(self, answer, chunks, chunk_v, embd_mdl, tkweight=0.1, vtweight=0.9):
         assert len(chunks) == len(chunk_v)
+        return self.insert_citations_vec(answer, chunks, self.normalize_rows(self.stack_vectors(chunk_v)), embd_mdl, tkweight, vtweight)
+
+    def insert_citations_vec(self, answer, chunks, chunk_mat, embd_mdl, tkweight=0.1, vtweight=0.9):
+        """为回答插入引用标记，chunk_mat 为预先堆叠并按行归一化的 chunk 向量矩阵 (num_chunks, dim)"""
+        assert len(chunks) == len(chunk_mat)
         if not chunks:
             return answer, set([])
         pieces = re.split(r"(```)", answer)
@@ -255,24 +282,27 @@ class Dealer:
             return answer, set([])
 
         ans_v, _ = embd_mdl.encode(pieces_)
-        for i in range(len(chunk_v)):
-            if len(ans_v[0]) != len(chunk_v[i]):
-                chunk_v[i] = [0.0] * len(ans_v[0])
-                logging.warning("The dimension of query and chunk do not match: {} vs. {}".format(len(ans_v[0]), len(chunk_v[i])))
-
-        assert len(ans_v[0]) == len(chunk_v[0]), "The dimension of query and chunk do not match: {} vs. {}".format(len(ans_v[0]), len(chunk_v[0]))
+        ans_mat = np.asarray(ans_v, dtype=np.float32)
+        if ans_mat.shape[1] != chunk_mat.shape[1]:
+            logging.warning("The dimension of query and chunk do not match: {} vs. {}".format(ans_mat.shape[1], chunk_mat.shape[1]))
+            chunk_mat = np.zeros((len(chunks), ans_mat.shape[1]), dtype=np.float32)
 
+        # 一次矩阵乘法得到所有 (回答片段, chunk) 的余弦相似度
+        vtsim = self.normalize_rows(ans_mat) @ chunk_mat.T
         chunks_tks = [rag_tokenizer.tokenize(self.qryr.rmWWW(ck)).split() for ck in chunks]
+        tksim = np.array([self.qryr.token_similarity(rag_tokenizer.tokenize(self.qryr.rmWWW(a)).split(), chunks_tks) for a in pieces_])
+        # 向量相似度全为 0 的片段只使用词元相似度，与 hybrid_similarity 保持一致
+        sim = np.where(vtsim.sum(axis=1, keepdims=True) == 0, tksim, vtsim * vtweight + tksim * tkweight)
+        mx = np.max(sim, axis=1) * 0.99
+
         cites = {}
         thr = 0.63
         while thr > 0.3 and len(cites.keys()) == 0 and pieces_ and chunks_tks:
-            for i, a in enumerate(pieces_):
-                sim, tksim, vtsim = self.qryr.hybrid_similarity(ans_v[i], chunk_v, rag_tokenizer.tokenize(self.qryr.rmWWW(pieces_[i])).split(), chunks_tks, tkweight, vtweight)
-                mx = np.max(sim) * 0.99
-                logging.debug("{} SIM: {}".format(pieces_[i], mx))
-                if mx < thr:
+            for i in range(len(pieces_)):
+                logging.debug("{} SIM: {}".format(pieces_[i], mx[i]))
+                if mx[i] < thr:
                     continue
-                cites[idx[i]] = list(set([str(ii) for ii in range(len(chunk_v)) if sim[ii] > mx]))[:4]
+                cites[idx[i]] = list(set([str(ii) for ii in np.nonzero(sim[i] > mx[i])[0]]))[:4]
             thr *= 0.8
 
         res = ""
@@ -284,7 +314,7 @@ class Dealer:
             if i not in cites:
                 continue
             for c in cites[i]:
-                assert int(c) < len(chunk_v)
+                assert int(c) < len(chunk_mat)
             for c in cites[i]:
                 if c in seted:
                     continue
@@ -417,6 +447,7 @@ class Dealer:
         rerank_mdl=None,
         highlight=False,
         rank_feature: dict | None = {PAGERANK_FLD: 10},
+        query_vector: list[float] | None = None,
     ):
         """
         执行检索操作，根据问题查询相关文档片段
@@ -436,6 +467,7 @@ class Dealer:
         - rerank_mdl: 重排序模型
         - highlight: 是否高亮匹配内容
         - rank_feature: 排序特征，如PageRank值
+        - query_vector: 预先计算好的查询向量，提供时不再调用嵌入模型
 
         返回:
         包含检索结果的字典，包括总数、文档片段和文档聚合信息
@@ -461,6 +493,8 @@ class Dealer:
             "similarity": similarity_threshold,
             "available_int": 1,
         }
+        if query_vector is not None:
+            req["query_vector"] = query_vector
 
         # 处理租户ID格式
         if isinstance(tenant_ids, str):
@@ -528,6 +562,12 @@ class Dealer:
 
         return ranks
 
+    def retrieval_with_vector(self, query_vector, question, embd_mdl, *args, **kwargs):
+        """
+        使用预先计算好的查询向量执行检索，其余参数含义同 retrieval
+        """
+        return self.retrieval(question, embd_mdl, *args, query_vector=query_vector, **kwargs)
+
     def sql_retrieval(self, sql, fetch_size=128, format="json"):
         tbl = self.dataStore.sql(sql, fetch_size, format)
         return tbl